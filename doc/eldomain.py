@@ -20,7 +20,7 @@
 # SOFTWARE.
 
 import re
-from itertools import ifilter
+from itertools import chain
 
 from docutils import nodes, utils
 from docutils.parsers.rst import directives
@@ -44,6 +44,57 @@ def make_target(scope, name):
     return 'el.{0}.{1}'.format(scope, name)
 
 
+def get_scopes(symbols, name):
+    """Get the scopes of the symbol ``name`` from ``symbols``.
+
+    ``symbols`` is the symbol table of the Emacs Lisp domain, which maps the
+    name of every symbol to a tuple of ``(scope, docname, objtype)`` triples.
+
+    Return a dictionary mapping every scope of the symbol to a pair of
+    ``(docname, objtype)``.  The dictionary is empty if ``name`` is not in
+    ``symbols``.
+
+    """
+    return dict((scope, (docname, objtype))
+                for scope, docname, objtype in symbols.get(name, ()))
+
+
+def set_scope(symbols, name, scope, docname, objtype):
+    """Set the symbol ``name`` in ``scope`` in ``symbols``.
+
+    ``docname`` is the document and ``objtype`` the object type of the
+    description of the symbol.  See :func:`get_scopes` for ``symbols``.
+
+    Return the pair of ``(docname, objtype)`` which the symbol previously had
+    in ``scope``, or ``None`` if it had none.
+
+    """
+    entries = symbols.get(name, ())
+    previous = None
+    for index, entry in enumerate(entries):
+        if entry[0] == scope:
+            previous = entry[1:]
+            entries = entries[:index] + entries[index + 1:]
+            break
+    symbols[name] = entries + ((scope, docname, objtype),)
+    return previous
+
+
+def remove_scope(symbols, name, scope):
+    """Remove the symbol ``name`` in ``scope`` from ``symbols``.
+
+    Remove the symbol altogether, if it has no other scopes.  See
+    :func:`get_scopes` for ``symbols``.
+
+    """
+    entries = tuple(entry for entry in symbols.get(name, ())
+                    if entry[0] != scope)
+    if entries:
+        symbols[name] = entries
+    else:
+        symbols.pop(name, None)
+
+
 class el_parameterlist(addnodes.desc_parameterlist):
     """A container node for the parameter list of a Emacs Lisp function."""
     child_text_separator = ' '
@@ -65,17 +116,24 @@ class el_metavariable(nodes.emphasis):
 
 
 class EmacsLispSymbol(ObjectDescription):
-    """A directive to describe an Emacs Lisp symbol."""
+    """A directive to describe an Emacs Lisp symbol.
 
-    @property
-    def object_type(self):
-        """The :class:`~sphinx.domains.ObjType` of this directive."""
-        return self.env.domains[self.domain].object_types[self.objtype]
+    :attr:`object_type` is the :class:`~sphinx.domains.ObjType` of this
+    directive, and :attr:`emacs_lisp_scope` the scope of this object type as
+    string.  :attr:`domain_data` is the data of the Emacs Lisp domain.  All
+    are set once in :meth:`run`.
 
-    @property
-    def emacs_lisp_scope(self):
-        """The scope of this object type as string."""
-        return self.object_type.attrs['scope']
+    """
+
+    def run(self):
+        # ObjectDescription only sets domain, objtype and env while running,
+        # so we resolve them from the directive name once per directive
+        env = self.state.document.settings.env
+        domain, objtype = self.name.split(':', 1)
+        self.object_type = env.domains[domain].object_types[objtype]
+        self.emacs_lisp_scope = self.object_type.attrs['scope']
+        self.domain_data = env.domaindata[domain]
+        return ObjectDescription.run(self)
 
     def make_type_annotation(self):
         """Create the type annotation for this directive.
@@ -84,13 +142,19 @@ class EmacsLispSymbol(ObjectDescription):
         node.
 
         """
-        type_name = self.object_type.lname.title() + ' '
+        type_name = TYPE_ANNOTATIONS[self.objtype]
         return el_annotation(type_name, type_name)
 
-    def handle_signature(self, sig, signode):
-        parts = sig.split()
+    def emit_signature(self, parts, signode):
+        """Add the type annotation and the name of a symbol to ``signode``.
+
+        ``parts`` is the list of whitespace-separated parts of the signature,
+        whose first element is the name of the symbol.
+
+        Return the name of the symbol.
+
+        """
         name = parts[0]
-        arguments = parts[1:]
 
         annotation = self.make_type_annotation()
         if annotation:
@@ -100,6 +164,9 @@ class EmacsLispSymbol(ObjectDescription):
 
         return name
 
+    def handle_signature(self, sig, signode):
+        return self.emit_signature(sig.split(), signode)
+
     def add_target_and_index(self, name, sig, signode):
         # We must add the scope to target names, because Emacs Lisp allows for
         # variables and commands with the same name
@@ -110,18 +177,28 @@ class EmacsLispSymbol(ObjectDescription):
             signode['first'] = not self.names
             self.state.document.note_explicit_target(signode)
 
-            data = self.env.domaindata[self.domain]
-            symbol_scopes = data['symbols'].setdefault(name, {})
-            if self.emacs_lisp_scope in symbol_scopes:
+            objects = self.domain_data['objects']
+            previous = set_scope(self.domain_data['symbols'], name,
+                                 self.emacs_lisp_scope, self.env.docname,
+                                 self.objtype)
+            if previous:
+                other_docname = previous[0]
                 self.state_machine.reporter.warning(
                     'duplicate object description of %s, ' % name +
-                    'other instance in ' +
-                    self.env.doc2path(symbol_scopes[self.emacs_lisp_scope][0]),
+                    'other instance in ' + self.env.doc2path(other_docname),
                     line=self.lineno)
-            symbol_scopes[self.emacs_lisp_scope] = (self.env.docname,
-                                                    self.objtype)
-
-        indextext = '{0}; Emacs Lisp {1}'.format(name, self.object_type.lname)
+                # This description replaces the other one
+                objects[other_docname] = [
+                    obj for obj in objects.get(other_docname, ())
+                    if obj[4] != targetname]
+            doc_objects = objects.get(self.env.docname)
+            if doc_objects is None:
+                doc_objects = objects[self.env.docname] = []
+            doc_objects.append((name, name, self.objtype, self.env.docname,
+                                targetname,
+                                self.object_type.attrs['searchprio']))
+
+        indextext = name + INDEX_SUFFIXES[self.objtype]
         self.indexnode['entries'].append(('pair', indextext, targetname, ''))
 
 
@@ -134,21 +211,28 @@ class EmacsLispFunction(EmacsLispSymbol):
     """
 
     def handle_signature(self, sig, signode):
-        parts = sig.split(' ')
-        name = parts[0]
+        parts = sig.split()
+        name = self.emit_signature(parts, signode)
         arguments = parts[1:]
-        name = EmacsLispSymbol.handle_signature(self, name, signode)
 
         paramlist = el_parameterlist(' '.join(arguments), '')
         signode += paramlist
+        # Bind the node types locally to spare global lookups in the loop
+        make_annotation = addnodes.desc_annotation
+        make_parameter = el_parameter
+        required_params = 0
         for arg in arguments:
-            if arg.startswith('&'):
-                paramlist += addnodes.desc_annotation(' ' + arg + ' ',
-                                                      ' ' + arg + ' ')
+            # split() never returns empty arguments
+            if arg[0] == '&':
+                keyword = ' ' + arg + ' '
+                paramlist += make_annotation(keyword, keyword)
             else:
-                node = el_parameter(arg, arg)
+                node = make_parameter(arg, arg)
                 node['noemph'] = True
                 paramlist += node
+                required_params += 1
+        # Spare the HTML writer from counting the parameters again
+        paramlist['required_params'] = required_params
 
         return name
 
@@ -193,7 +277,7 @@ class EmacsLispCommand(EmacsLispSymbol):
         return node
 
     def run(self):
-        nodes = ObjectDescription.run(self)
+        nodes = EmacsLispSymbol.run(self)
 
         # Insert a dedicated signature for the key binding before all other
         # signatures, but only for commands.  Nothing else has key bindings.
@@ -248,12 +332,11 @@ class EmacsLispSlotXRefRole(XRefRole):
         current_struct = env.temp_data.get('el:cl-struct')
         omit_struct = target.startswith('~')
         target = target.lstrip('~')
-        parts = target.split(' ', 1)
         # If the reference is given as "structure slot", adjust the title, and
         # reconstruct the function name
-        if len(parts) > 1:
-            struct, slot = parts
-            target = parts.join('-')
+        if ' ' in target:
+            struct, slot = target.split(' ', 1)
+            target = struct + '-' + slot
             # If the first character is a tilde, or if there is a current
             # structure, omit the structure name
             if not has_explicit_title and (omit_struct or current_struct == struct):
@@ -265,30 +348,40 @@ class EmacsLispSlotXRefRole(XRefRole):
         return title, target
 
 
+# In the following roles, keyword arguments with a leading underscore bind
+# globals at definition time, to spare the global lookups in functions that
+# are called for every use of a role
 def var_role(role, rawtext, text, lineno, inliner,
-             options={}, content=[]):
-    return [el_metavariable(rawtext, text)], []
+             options={}, content=[], _metavariable=el_metavariable):
+    return [_metavariable(rawtext, text)], []
 
 
 METAVAR_RE = re.compile('{([^}]+)}')
 
 
 def varcode_role(role, rawtext, text, lineno, inliner,
-                 options={}, content=[]):
-    text = utils.unescape(text)
-    position = 0
-    node = nodes.literal(rawtext, '', role=role, classes=[role])
-    for match in METAVAR_RE.finditer(text):
-        if match.start() > position:
-            trailing_text = text[position:match.start()]
-            node += nodes.Text(trailing_text, trailing_text)
-        node += el_metavariable(match.group(1), match.group(1))
-        position = match.end()
-    if position < len(text):
-        node += nodes.Text(text[position:], text[position:])
+                 options={}, content=[], _unescape=utils.unescape,
+                 _literal=nodes.literal, _text=nodes.Text,
+                 _metavariable=el_metavariable, _split=METAVAR_RE.split):
+    # Do not try to compile this role with a JIT like Numba: it has next to no
+    # support for strings and regular expressions, and falls back to its
+    # object mode, which is slower than plain Python.
+    text = _unescape(text)
+    node = _literal(rawtext, '', role=role, classes=[role])
+    # Since METAVAR_RE has a single group, split() alternates between literal
+    # text at even and meta variable names at odd indexes
+    for index, chunk in enumerate(_split(text)):
+        if index % 2:
+            node += _metavariable(chunk, chunk)
+        elif chunk:
+            node += _text(chunk, chunk)
     return [node], []
 
 
+# The scopes to use for ambiguous symbol references, in order of preference
+SCOPE_PRIORITY = ('function', 'variable', 'face', 'struct')
+
+
 class EmacsLispDomain(Domain):
     """A domain to document Emacs Lisp symbols."""
 
@@ -340,48 +433,77 @@ class EmacsLispDomain(Domain):
     }
     indices = []
 
-    data_version = 2
+    data_version = 5
     initial_data = {
-        # fullname -> scope -> (docname, objtype)
-        'symbols': {}
+        # fullname -> ((scope, docname, objtype), ...), see get_scopes()
+        'symbols': {},
+        # docname -> [(fullname, fullname, objtype, docname, target,
+        # searchprio)], as returned by get_objects()
+        'objects': {},
     }
 
     def clear_doc(self, docname):
         symbols = self.data['symbols']
-        for symbol, scopes in symbols.items():
-            for scope, (object_docname, _) in scopes.items():
-                if docname == object_docname:
-                    del symbols[symbol][scope]
+        objects = self.data['objects'].pop(docname, ())
+        for symbol, _, objtype, _, _, _ in objects:
+            scope = OBJECT_SCOPES[objtype]
+            remove_scope(symbols, symbol, scope)
 
     def resolve_xref(self, env, fromdoc, builder, objtype, target, node,
                      content):
-        scopes = self.data['symbols'][target]
-        if objtype == 'symbol' and len(scopes) > 1:
+        entries = self.data['symbols'].get(target)
+        if not entries:
+            # Let Sphinx handle references to unknown symbols
+            return None
+        if objtype == 'symbol' and len(entries) > 1:
             # The generic symbol reference is ambiguous, because the symbol has
             # multiple scopes attached
-            scope = next(ifilter(lambda s: s in scopes, ['function', 'variable',
-                                                         'face', 'struct']),
-                         None)
+            scopes = get_scopes(self.data['symbols'], target)
+            scope = None
+            for candidate in SCOPE_PRIORITY:
+                if candidate in scopes:
+                    scope = candidate
+                    break
             if not scope:
                 # If we have an unknown scope
                 raise ValueError('Unknown scopes: {0!r}'.format(scopes))
             message = 'Ambiguous reference to {0}, in scopes {1}, using {2}'.format(
                 target, ', '.join(scopes), scope)
             env.warn(fromdoc, message, getattr(node, 'line'))
+            docname, _ = scopes[scope]
+        elif objtype == 'symbol':
+            # A generic reference to a symbol with a single scope
+            scope, docname, _ = entries[0]
         else:
-            scope = self.object_types[objtype].attrs['scope']
-        if scope not in scopes:
-            return None
-        docname, _ = scopes[scope]
+            scope = OBJECT_SCOPES[objtype]
+            # Symbols have only a few scopes, so scan them directly instead of
+            # building a dictionary
+            for entry_scope, docname, _ in entries:
+                if entry_scope == scope:
+                    break
+            else:
+                return None
         return make_refnode(builder, fromdoc, docname,
                             make_target(scope, target), content, target)
 
     def get_objects(self):
-        for symbol, scopes in self.data['symbols'].iteritems():
-            for scope, (docname, objtype) in scopes.iteritems():
-                yield (symbol, symbol, objtype, docname,
-                       make_target(scope, symbol),
-                       self.object_types[objtype].attrs['searchprio'])
+        return chain.from_iterable(self.data['objects'].itervalues())
+
+
+# objtype -> the scope of this object type
+OBJECT_SCOPES = dict((objtype, object_type.attrs['scope'])
+                     for objtype, object_type
+                     in EmacsLispDomain.object_types.iteritems())
+
+# objtype -> the text of the type annotation of this object type
+TYPE_ANNOTATIONS = dict((objtype, object_type.lname.title() + ' ')
+                        for objtype, object_type
+                        in EmacsLispDomain.object_types.iteritems())
+
+# objtype -> the suffix of index entries for this object type
+INDEX_SUFFIXES = dict((objtype, '; Emacs Lisp ' + object_type.lname)
+                      for objtype, object_type
+                      in EmacsLispDomain.object_types.iteritems())
 
 
 def noop(self, node):
@@ -396,10 +518,15 @@ def delegate(target_type):
     process a node.
 
     """
-    visit = lambda s, n: getattr(s, 'visit_{0}'.format(
-        target_type.__name__))(n)
-    depart = lambda s, n: getattr(s, 'depart_{0}'.format(
-        target_type.__name__))(n)
+    visit_name = 'visit_' + target_type.__name__
+    depart_name = 'depart_' + target_type.__name__
+
+    def visit(self, node):
+        getattr(self, visit_name)(node)
+
+    def depart(self, node):
+        getattr(self, depart_name)(node)
+
     return (visit, depart)
 
 
@@ -407,8 +534,11 @@ def visit_el_parameterlist_html(self, node):
     self.body.append(' ')
     self.first_param = 1
     self.optional_param_level = 0
-    self.required_params_left = sum([isinstance(c, addnodes.desc_parameter)
-                                         for c in node.children])
+    required_params = node.get('required_params')
+    if required_params is None:
+        required_params = sum(1 for c in node.children
+                              if isinstance(c, addnodes.desc_parameter))
+    self.required_params_left = required_params
     self.param_separator = node.child_text_separator
 
 
@@ -428,14 +558,17 @@ def depart_el_annotation_texinfo(self, node):
     self.depart_desc_annotation(node)
 
 
+# A translation table to replace no-break spaces in Texinfo output
+TEXINFO_NO_BREAK_SPACE = {0xa0: u'@w{ }'}
+
+
 def visit_el_parameter_texinfo(self, node):
     if not self.first_param:
         self.body.append(' ')
     else:
         self.first_param = 0
-    text = self.escape(node.astext())
     # replace no-break spaces with normal ones
-    text = text.replace(u' ', '@w{ }')
+    text = self.escape(node.astext()).translate(TEXINFO_NO_BREAK_SPACE)
     self.body.append(text)
     # Don't process the children
     raise nodes.SkipNode